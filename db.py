@@ -0,0 +1,16 @@
+import os
+from dotenv import load_dotenv
+import asyncpg
+
+load_dotenv()
+
+# Supabase pooler (Supavisor) in transaction mode, port 6543. Used by both the API and the worker.
+SUPABASE_PG_DSN = os.getenv("SUPABASE_PG_DSN")
+
+async def create_pg_pool():
+    if not SUPABASE_PG_DSN: return None
+    # Transaction mode hands each statement to any backend, so prepared statements can't be cached
+    return await asyncpg.create_pool(
+        dsn=SUPABASE_PG_DSN, min_size=2, max_size=10,
+        statement_cache_size=0, max_inactive_connection_lifetime=300,
+    )
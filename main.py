@@ -1,60 +1,105 @@
-from fastapi import FastAPI, Depends, Request
+from fastapi import FastAPI, Depends, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional
+from pydantic import BaseModel, Field
+from typing import Any, Optional
 from dotenv import load_dotenv
 import os
+import asyncio
+import time
+import hashlib
+import json
 import arq
+import asyncpg
 from arq import create_pool
 from arq.connections import ArqRedis, RedisSettings
-import uuid 
+import secrets
+import msgpack
+from functools import partial
+from contextlib import asynccontextmanager
+from redis.exceptions import ResponseError
+from db import create_pg_pool
 
 load_dotenv()
 
-app = FastAPI()
-
 # --- Pydantic Models ---
+# Reject oversized payloads at ingress so they never reach Redis or Gemini
+MAX_FIELD_CHARS = 1_000
+MAX_BIO_CHARS = 20_000
+MAX_DOCUMENT_CHARS = 2_000_000
+
 class TranscriptInput(BaseModel):
-    company: Optional[str] = "Unknown Company"
-    attendees: Optional[str] = "Not specified"
-    date: Optional[str] = "Unknown date"
-    transcript: Optional[str] = ""
+    company: Optional[str] = Field("Unknown Company", max_length=MAX_FIELD_CHARS)
+    attendees: Optional[str] = Field("Not specified", max_length=MAX_FIELD_CHARS)
+    date: Optional[str] = Field("Unknown date", max_length=MAX_FIELD_CHARS)
+    transcript: Optional[str] = Field("", max_length=MAX_DOCUMENT_CHARS)
 
 class IcebreakerInput(BaseModel):
-    linkedin_bio: str
-    pitch_deck: str
+    linkedin_bio: str = Field(max_length=MAX_BIO_CHARS)
+    pitch_deck: str = Field(max_length=MAX_DOCUMENT_CHARS)
+
+# Declared response models let FastAPI serialize with Pydantic directly instead of
+# running jsonable_encoder + json.dumps; unset fields are dropped so payloads are unchanged
+class JobQueuedResponse(BaseModel):
+    status: Optional[str] = None
+    job_id: Optional[str] = None
+    error: Optional[str] = None
+
+class JobResultResponse(BaseModel):
+    status: str
+    analysis: Optional[str] = None
+    partial: Optional[str] = None
+
+class HistoryResponse(BaseModel):
+    data: Optional[list[dict[str, Any]]] = None
+    error: Optional[str] = None
 
 # --- Queue Setup ---
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
 redis_settings = RedisSettings.from_dsn(REDIS_URL)
+# Must match WorkerSettings.job_serializer/job_deserializer in worker.py
+job_serializer = partial(msgpack.packb, use_bin_type=True)
+job_deserializer = partial(msgpack.unpackb, raw=False)
 
-async def get_queue() -> ArqRedis:
-    return await create_pool(redis_settings)
+async def get_queue(request: Request) -> ArqRedis:
+    # Reuse the pool opened at startup instead of connecting per request
+    return request.app.state.queue
 
-@app.on_event("startup")
-async def startup():
-    app.state.queue = await get_queue()
+# --- Postgres Setup (History Panel reads) ---
+# Pool from db.py when SUPABASE_PG_DSN is set; otherwise the REST client below is used
+async def get_pg_pool(request: Request) -> Optional[asyncpg.Pool]:
+    return request.app.state.pg_pool
 
-@app.on_event("shutdown")
-async def shutdown():
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.queue = await create_pool(redis_settings, job_serializer=job_serializer, job_deserializer=job_deserializer)
+    app.state.pg_pool = await create_pg_pool()
+    yield
     await app.state.queue.close()
+    if app.state.pg_pool is not None: await app.state.pg_pool.close()
+
+app = FastAPI(lifespan=lifespan)
 
 # --- Middleware ---
 
 # *** THIS IS THE FIX ***
 # We are now only allowing your Vercel app and localhost to make requests
+# (FRONTEND_ORIGINS overrides the list, comma-separated)
 allow_origins = [
     "https://business-sherpa-frontend.vercel.app", # Your live frontend
     "http://localhost:3000",                  # For local development
 ]
+if os.getenv("FRONTEND_ORIGINS"):
+    allow_origins = [origin.strip() for origin in os.getenv("FRONTEND_ORIGINS").split(",") if origin.strip()]
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=allow_origins,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# Set CORS_AT_PROXY=1 when an edge proxy/CDN already answers CORS, to skip the middleware entirely
+if os.getenv("CORS_AT_PROXY") != "1":
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=allow_origins,
+        allow_credentials=True,
+        allow_methods=["GET", "POST"],
+        allow_headers=["content-type", "authorization"],
+    )
 
 # --- Endpoints ---
 
@@ -62,35 +107,105 @@ app.add_middleware(
 def home():
     return {"message": "Backend API is running!"}
 
-@app.post("/analyze_transcript")
+# --- Single-flight for identical jobs ---
+# Must match JOB_TIMEOUT/INFLIGHT_TTL in worker.py. The TTL starts at enqueue and the worker
+# restarts it when the job begins; if it lapses during a queue backlog, the next identical
+# request just becomes a new leader (the old job only releases a lock it still holds)
+JOB_TIMEOUT = 300
+INFLIGHT_TTL = JOB_TIMEOUT + 60
+
+# Atomically either claim inflight:{hash} for this job, or attach this job id as a
+# follower of the job already holding it (the worker publishes the result to followers,
+# and leader:{follower} points the follower at the leader's partial output)
+SINGLE_FLIGHT_SCRIPT = """
+local leader = redis.call('GET', KEYS[1])
+if leader then
+    redis.call('SADD', 'followers:' .. leader, ARGV[1])
+    redis.call('EXPIRE', 'followers:' .. leader, ARGV[2])
+    redis.call('SET', 'leader:' .. ARGV[1], leader, 'EX', ARGV[2])
+    return leader
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return false
+"""
+
+async def enqueue_single_flight(queue: ArqRedis, function: str, item_dict: dict):
+    job_id = secrets.token_hex(16)
+    payload = json.dumps([function, item_dict], sort_keys=True).encode()
+    inflight_key = "inflight:" + hashlib.blake2b(payload, digest_size=16).hexdigest()
+    leader = await queue.eval(SINGLE_FLIGHT_SCRIPT, 1, inflight_key, job_id, INFLIGHT_TTL)
+    if leader is None:
+        try:
+            await queue.enqueue_job(function, job_id, item_dict, inflight_key)
+        except Exception:
+            await queue.delete(inflight_key)
+            raise
+    return job_id
+
+@app.post("/analyze_transcript", response_model=JobQueuedResponse, response_model_exclude_none=True)
 async def queue_transcript_analysis(item: TranscriptInput, queue: ArqRedis = Depends(get_queue)):
-    job_id = str(uuid.uuid4())
     try:
-        await queue.enqueue_job("run_transcript_analysis", job_id, item.dict())
+        job_id = await enqueue_single_flight(queue, "run_transcript_analysis", item.model_dump(mode='json'))
         return {"status": "queued", "job_id": job_id}
     except Exception as e:
         return {"error": f"Failed to queue job: {str(e)}"}
 
 
-@app.post("/generate_icebreaker")
+@app.post("/generate_icebreaker", response_model=JobQueuedResponse, response_model_exclude_none=True)
 async def queue_icebreaker_generation(item: IcebreakerInput, queue: ArqRedis = Depends(get_queue)):
-    job_id = str(uuid.uuid4())
     try:
-        await queue.enqueue_job("run_icebreaker_generation", job_id, item.dict())
+        job_id = await enqueue_single_flight(queue, "run_icebreaker_generation", item.model_dump(mode='json'))
         return {"status": "queued", "job_id": job_id}
     except Exception as e:
         return {"error": f"Failed to queue job: {str(e)}"}
 
-@app.get("/get_job_result")
+# Flipped on the first "unknown command" so Redis < 6.2 doesn't pay a failed GETDEL per call
+getdel_supported = True
+
+async def pop_result(queue: ArqRedis, key: str):
+    global getdel_supported
+    # GETDEL fetches and removes in one round-trip (Redis >= 6.2)
+    if getdel_supported:
+        try:
+            return await queue.execute_command("GETDEL", key)
+        except ResponseError:
+            getdel_supported = False
+    # Older Redis: pipeline GET + DEL so we still pay a single RTT
+    async with queue.pipeline(transaction=False) as pipe:
+        pipe.get(key)
+        pipe.delete(key)
+        result, _ = await pipe.execute()
+    return result
+
+# How long /get_job_result blocks waiting for the worker before reporting "pending"
+RESULT_WAIT_TIMEOUT = 25
+# Each waiter holds a pooled Redis connection for up to RESULT_WAIT_TIMEOUT; past this many,
+# requests answer "pending" immediately and the client polls as before
+MAX_RESULT_WAITERS = 50
+result_waiters = asyncio.Semaphore(MAX_RESULT_WAITERS)
+
+@app.get("/get_job_result", response_model=JobResultResponse, response_model_exclude_none=True)
 async def get_job_result(job_id: str, queue: ArqRedis = Depends(get_queue)):
     key = f"result:{job_id}"
-    result = await queue.get(key)
+    result = await pop_result(queue, key)
+
+    if not result and not result_waiters.locked():
+        async with result_waiters:
+            # Block until the worker pushes to notify:{job_id} instead of making the client poll
+            notified = await queue.blpop(f"notify:{job_id}", timeout=RESULT_WAIT_TIMEOUT)
+            if notified:
+                # Non-destructive read: if this client already gave up, its next poll still finds
+                # the result; the worker's ex=300 cleans it up
+                result = await queue.get(key)
     
     if result:
-        await queue.delete(key) 
         return {"status": "complete", "analysis": result.decode('utf-8')}
     else:
-        return {"status": "pending"}
+        # Followers of a deduplicated job read the leader's partial output
+        leader = await queue.get(f"leader:{job_id}")
+        stream_job_id = leader.decode('utf-8') if leader else job_id
+        partial_output = await queue.get(f"stream:{stream_job_id}")
+        return {"status": "pending", "partial": partial_output.decode('utf-8') if partial_output else ""}
 
 
 # Supabase client for History Panel (still needed)
@@ -99,18 +214,58 @@ supabase_url = os.getenv("SUPABASE_URL")
 supabase_key = os.getenv("SUPABASE_SERVICE_KEY")
 supabase: Client = create_client(supabase_url, supabase_key)
 
-@app.get("/get_analyses")
-def get_analyses():
-    if supabase is None: return {"error": "Database not connected"}
+# --- HTTP caching for the History Panel ---
+HISTORY_CACHE_CONTROL = "public, max-age=5"
+
+async def history_etag(table: str, pg_pool: Optional[asyncpg.Pool], *params) -> str:
+    # Only the newest created_at is read, so a new row changes the ETag without refetching the list
+    if pg_pool is not None:
+        latest = await pg_pool.fetchval(f"SELECT max(created_at) FROM {table}")
+    else:
+        response = await asyncio.to_thread(lambda: supabase.table(table).select("created_at").order("created_at", desc=True).limit(1).execute())
+        latest = response.data[0]["created_at"] if response.data else None
+    return '"' + hashlib.sha1(str((latest, *params)).encode()).hexdigest() + '"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    return bool(if_none_match) and etag in [tag.strip() for tag in if_none_match.split(",")]
+
+@app.get("/get_analyses", response_model=HistoryResponse, response_model_exclude_none=True)
+async def get_analyses(request: Request, response: Response, limit: int = Query(50, ge=1, le=200), offset: int = Query(0, ge=0), pg_pool: Optional[asyncpg.Pool] = Depends(get_pg_pool)):
+    if pg_pool is None and supabase is None: return {"error": "Database not connected"}
     try:
-        response = supabase.table("meeting_analysis").select("*").order("created_at", desc=True).execute()
-        return {"data": response.data}
+        etag = await history_etag("meeting_analysis", pg_pool, limit, offset)
+        headers = {"ETag": etag, "Cache-Control": HISTORY_CACHE_CONTROL}
+        if etag_matches(request, etag): return Response(status_code=304, headers=headers)
+        response.headers.update(headers)
+        if pg_pool is not None:
+            rows = await pg_pool.fetch("SELECT * FROM meeting_analysis ORDER BY created_at DESC LIMIT $1 OFFSET $2", limit, offset)
+            return {"data": [dict(r) for r in rows]}
+        result = await asyncio.to_thread(lambda: supabase.table("meeting_analysis").select("*").order("created_at", desc=True).range(offset, offset + limit - 1).execute())
+        return {"data": result.data}
     except Exception as e: return {"error": str(e)}
 
-@app.get("/get_icebreakers")
-def get_icebreakers():
-    if supabase is None: return {"error": "Database not connected"}
+# Small TTL cache for the icebreaker snippet RPC, keyed by the SQL; entries also
+# carry the ETag they were built for so a new row invalidates them immediately
+ICEBREAKERS_SQL = "SELECT * FROM get_icebreakers_with_snippet()"
+ICEBREAKERS_CACHE_TTL = 60  # seconds
+_query_cache = {}
+
+@app.get("/get_icebreakers", response_model=HistoryResponse, response_model_exclude_none=True)
+async def get_icebreakers(request: Request, response: Response, pg_pool: Optional[asyncpg.Pool] = Depends(get_pg_pool)):
+    if pg_pool is None and supabase is None: return {"error": "Database not connected"}
     try:
-        response = supabase.rpc("get_icebreakers_with_snippet").execute()
-        return {"data": response.data}
+        etag = await history_etag("icebreaker_analysis", pg_pool)
+        headers = {"ETag": etag, "Cache-Control": HISTORY_CACHE_CONTROL}
+        if etag_matches(request, etag): return Response(status_code=304, headers=headers)
+        response.headers.update(headers)
+        cached = _query_cache.get(ICEBREAKERS_SQL)
+        if cached and cached[0] > time.monotonic() and cached[1] == etag: return {"data": cached[2]}
+        if pg_pool is not None:
+            data = [dict(r) for r in await pg_pool.fetch(ICEBREAKERS_SQL)]
+        else:
+            result = await asyncio.to_thread(lambda: supabase.rpc("get_icebreakers_with_snippet").execute())
+            data = result.data
+        _query_cache[ICEBREAKERS_SQL] = (time.monotonic() + ICEBREAKERS_CACHE_TTL, etag, data)
+        return {"data": data}
     except Exception as e: return {"error": str(e)}
\ No newline at end of file
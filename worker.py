@@ -1,9 +1,21 @@
 import os
+import asyncio
+import array
+import uuid
+import hashlib
 from dotenv import load_dotenv
 import google.generativeai as genai
 from supabase import create_client, Client
 import arq
+import json
+import msgpack
+from functools import partial
 from arq.connections import RedisSettings
+from redis.exceptions import ResponseError
+from redis.commands.search.field import TagField, VectorField
+from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+from redis.commands.search.query import Query
+from db import create_pg_pool
 
 load_dotenv()
 
@@ -22,105 +34,382 @@ else:
     supabase: Client = create_client(supabase_url, supabase_key)
 
 # --- AI Model Initialization ---
-transcript_model = None
-icebreaker_model = None
-if gemini_api_key:
+MODEL_NAME = 'gemini-2.5-flash-preview-09-2025'
+
+# Static system instruction + task framing per job type; only the per-job inputs are sent as the user turn
+MODEL_PREFIXES = {
+    "transcript": (
+        "You are an expert meeting analyst. Format your response in Markdown.",
+        """Please summarize (in Markdown):
+1. What was done well and why.
+2. What could be improved.
+3. 3 actionable recommendations.""",
+    ),
+    "icebreaker": (
+        "You are a world-class sales rep. Format your response in Markdown.",
+        """Analyze the LinkedIn bio and pitch deck you are given.
+Generate a cold outreach icebreaker... (rest of your prompt)
+
+IMPORTANT: Format your entire response using Markdown.""",
+    ),
+}
+
+def build_model(kind: str):
+    # The static prefix (~50 tokens) is far below Gemini's minimum cacheable size, so it is
+    # sent as the system instruction rather than as a CachedContent
+    system_instruction, task_prefix = MODEL_PREFIXES[kind]
+    return genai.GenerativeModel(MODEL_NAME, system_instruction=f"{system_instruction}\n\n{task_prefix}")
+
+# Per-job user turn; filled with str.format_map(item_dict)
+PROMPT_TEMPLATES = {
+    "transcript": """
+Review the following meeting transcript from {company} held on {date} with {attendees}.
+Transcript: {transcript}
+""",
+    "icebreaker": """
+Bio: {linkedin_bio}
+Deck: {pitch_deck}
+""",
+}
+
+# Built in the arq on_startup hook, so importing this module stays cheap
+models = {"transcript": None, "icebreaker": None}
+
+# --- Input Token Budget ---
+MAX_INPUT_TOKENS = 900_000
+
+async def fit_to_token_budget(kind: str, text: str) -> str:
+    # Every token covers at least one UTF-8 byte (rare characters fall back to byte tokens),
+    # so inputs within the budget in bytes can't exceed it: skip the count RPC
+    if not text or len(text.encode('utf-8')) <= MAX_INPUT_TOKENS: return text
+    tokens = (await models[kind].count_tokens_async(text)).total_tokens
+    while tokens > MAX_INPUT_TOKENS:
+        # Keep the head and tail, where meetings/decks usually carry the most context
+        keep = int(len(text) * MAX_INPUT_TOKENS / tokens * 0.95) // 2
+        text = text[:keep] + "\n…\n" + text[-keep:]
+        tokens = (await models[kind].count_tokens_async(text)).total_tokens
+    return text
+
+# --- Semantic Cache (RediSearch HNSW) ---
+EMBED_MODEL = 'models/text-embedding-004'
+EMBED_DIM = 768
+# text-embedding-004 reads at most 2,048 tokens and silently truncates the rest; longer
+# documents only use the exact-match entry so two inputs sharing a prefix can't collide
+EMBED_MAX_CHARS = 6_000
+SEMANTIC_CACHE_THRESHOLD = 0.97
+SEMANTIC_CACHE_TTL = 60 * 60 * 24
+
+# kind -> (index name, hash key prefix)
+SEMANTIC_INDEXES = {
+    "transcript": ("idx:analyses", "analysis:"),
+    "icebreaker": ("idx:icebreakers", "icebreaker:"),
+}
+
+async def ensure_semantic_indexes(redis) -> bool:
+    for index_name, prefix in SEMANTIC_INDEXES.values():
+        try:
+            await redis.ft(index_name).info()
+        except ResponseError:
+            try:
+                await redis.ft(index_name).create_index(
+                    [
+                        TagField("scope"),
+                        VectorField("v", "HNSW", {"TYPE": "FLOAT32", "DIM": EMBED_DIM, "DISTANCE_METRIC": "COSINE"}),
+                    ],
+                    definition=IndexDefinition(prefix=[prefix], index_type=IndexType.HASH),
+                )
+            except ResponseError as e:
+                # Redis without the search module: run without the semantic cache
+                print(f"WORKER: Semantic cache disabled ({e})")
+                return False
+    return True
+
+def semantic_scope(*fields) -> str:
+    # Exact-match key for everything except the embedded document (e.g. the bio an icebreaker is written for)
+    return hashlib.sha256(json.dumps(fields).encode()).hexdigest()
+
+def exact_cache_key(kind: str, document: str, scope: str) -> str:
+    return f"exact:{kind}:" + hashlib.sha256(f"{scope}:{document}".encode()).hexdigest()
+
+async def semantic_cache_lookup(ctx, kind: str, document: str, scope: str):
+    # Exact resubmissions hit a plain GET first, so they skip the embed RPC and FT.SEARCH and
+    # work for documents of any length. Short documents then fall back to a semantic KNN match
+    # within the same scope. Returns (embedding bytes or None, cached analysis or None);
+    # any failure is treated as a miss
+    if not document: return None, None
+    try:
+        cached = await ctx['redis'].get(exact_cache_key(kind, document, scope))
+        if cached: return None, cached.decode('utf-8')
+        if not ctx.get('semantic_cache') or len(document) > EMBED_MAX_CHARS: return None, None
+        result = await genai.embed_content_async(model=EMBED_MODEL, content=document)
+        vector = array.array('f', result['embedding']).tobytes()
+        query = Query(f"(@scope:{{{scope}}})=>[KNN 1 @v $q AS score]").return_fields("analysis", "score").dialect(2)
+        found = await ctx['redis'].ft(SEMANTIC_INDEXES[kind][0]).search(query, query_params={"q": vector})
+    except Exception as e:
+        print(f"WORKER: Semantic cache lookup failed: {e}")
+        return None, None
+    if found.docs and 1 - float(found.docs[0].score) >= SEMANTIC_CACHE_THRESHOLD:
+        analysis = found.docs[0].analysis
+        return vector, analysis.decode('utf-8') if isinstance(analysis, bytes) else analysis
+    return vector, None
+
+async def semantic_cache_store(redis, kind: str, document: str, vector: bytes, scope: str, output: str):
+    if not document: return
     try:
-        transcript_model = genai.GenerativeModel('gemini-2.5-flash-preview-09-2025', system_instruction="You are an expert meeting analyst. Format your response in Markdown.")
-        icebreaker_model = genai.GenerativeModel('gemini-2.5-flash-preview-09-2025', system_instruction="You are a world-class sales rep. Format your response in Markdown.")
-    except Exception as e: print(f"Error initializing GenerativeModels: {e}")
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.set(exact_cache_key(kind, document, scope), output, ex=SEMANTIC_CACHE_TTL)
+            if vector is not None:
+                key = f"{SEMANTIC_INDEXES[kind][1]}{uuid.uuid4()}"
+                pipe.hset(key, mapping={"v": vector, "scope": scope, "analysis": output})
+                pipe.expire(key, SEMANTIC_CACHE_TTL)
+            await pipe.execute()
+    except Exception as e:
+        # A cache write failure must not fail a job whose output is already generated
+        print(f"WORKER: Semantic cache store failed: {e}")
 
-# --- Worker Functions (The Jobs) ---
+# --- Batched Supabase Inserts ---
+INSERT_BATCH_SIZE = 50
+INSERT_FLUSH_INTERVAL = 0.25  # seconds
 
-async def run_transcript_analysis(ctx, job_id: str, item_dict: dict):
-    redis = ctx['redis'] 
-    if transcript_model is None or supabase is None:
-        print("WORKER ERROR: Models or Supabase not initialized.")
-        await redis.set(f"result:{job_id}", "Error: Worker not initialized", ex=300)
+# Jobs enqueue rows here; one writer task per table flushes them as multi-row inserts
+insert_queues = {"meeting_analysis": asyncio.Queue(), "icebreaker_analysis": asyncio.Queue()}
+# Query builders reused for the REST fallback instead of calling supabase.table() per batch
+supabase_tables = {table: supabase.table(table) for table in insert_queues} if supabase else {}
+
+INSERT_COLUMNS = {
+    "meeting_analysis": "company, attendees, date, transcript, analysis",
+    "icebreaker_analysis": "linkedin_bio, pitch_deck, analysis",
+}
+
+async def insert_batch(table: str, rows: list, pg_pool=None):
+    if pg_pool is not None:
+        try:
+            # One statement per batch; Postgres coerces the JSON fields to the column types like PostgREST does
+            columns = INSERT_COLUMNS[table]
+            await pg_pool.execute(
+                f"INSERT INTO {table} ({columns}) SELECT {columns} FROM jsonb_populate_recordset(NULL::{table}, $1::jsonb)",
+                json.dumps(rows),
+            )
+            return
+        except Exception as e:
+            if not supabase_tables: raise
+            print(f"WORKER: Postgres insert into '{table}' failed ({e}), falling back to Supabase REST.")
+    await asyncio.to_thread(lambda: supabase_tables[table].insert(rows).execute())
+
+async def write_rows(table: str, rows: list, pg_pool=None):
+    try:
+        await insert_batch(table, rows, pg_pool)
         return
-    
+    except Exception as e:
+        if len(rows) == 1:
+            print(f"WORKER ERROR: Dropped 1 row for '{table}': {e}")
+            return
+        print(f"WORKER ERROR: Batch insert of {len(rows)} rows into '{table}' failed ({e}), retrying row by row.")
+    # Isolate the bad row(s) so the rest of the batch is still saved
+    for row in rows:
+        try: await insert_batch(table, [row], pg_pool)
+        except Exception as e: print(f"WORKER ERROR: Dropped 1 row for '{table}': {e}")
+
+async def insert_writer(table: str, queue: asyncio.Queue, pg_pool=None):
+    loop = asyncio.get_running_loop()
+    rows = []
     try:
-        prompt = f"""
-        Review the following meeting transcript from {item_dict.get('company')} held on {item_dict.get('date')} with {item_dict.get('attendees')}.
-        Transcript: {item_dict.get('transcript')}
-        
-        Please summarize (in Markdown):
-        1. What was done well and why.
-        2. What could be improved.
-        3. 3 actionable recommendations.
-        """
-        
-        response = transcript_model.generate_content(prompt)
-        output = response.text.strip()
-
-        # 1. Save to Supabase (for history)
-        # *** THIS IS THE FIX ***
-        data_to_insert = {
-            "company": item_dict.get('company'),
-            "attendees": item_dict.get('attendees'),
-            "date": item_dict.get('date'),
-            "transcript": item_dict.get('transcript'),
-            "analysis": output,
-        }
-        supabase.table("meeting_analysis").insert(data_to_insert).execute()
-        
-        # 2. Save result to Redis FOR THE FRONTEND
-        await redis.set(f"result:{job_id}", output, ex=300) 
-        
-        print(f"WORKER: Successfully processed job {job_id}")
+        while True:
+            rows.append(await queue.get())
+            deadline = loop.time() + INSERT_FLUSH_INTERVAL
+            while len(rows) < INSERT_BATCH_SIZE:
+                remaining = deadline - loop.time()
+                if remaining <= 0: break
+                try: rows.append(await asyncio.wait_for(queue.get(), remaining))
+                except asyncio.TimeoutError: break
+            # Rows stay buffered until the write completes, so a cancel mid-write re-flushes them below
+            await write_rows(table, rows, pg_pool)
+            rows = []
+    except asyncio.CancelledError:
+        # Worker shutting down: flush whatever is still buffered
+        while not queue.empty(): rows.append(queue.get_nowait())
+        if rows: await write_rows(table, rows, pg_pool)
+        raise
+
+# --- Result Publishing ---
 
+# Release the single-flight lock only if this job still holds it (it may have expired during
+# a queue backlog and been claimed by a newer identical request), and collect the requests
+# that attached to this job, in one atomic step so no follower can join after the read
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then redis.call('DEL', KEYS[1]) end
+local followers = redis.call('SMEMBERS', KEYS[2])
+redis.call('DEL', KEYS[2])
+return followers
+"""
+
+# Restart the lock TTL when the job actually starts, if this job still holds it
+REFRESH_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('EXPIRE', KEYS[1], ARGV[2]) end
+return 0
+"""
+
+async def publish_result(redis, job_id: str, output: str, inflight_key: str = None):
+    job_ids = [job_id]
+    if inflight_key:
+        followers = await redis.eval(RELEASE_LOCK_SCRIPT, 2, inflight_key, f"followers:{job_id}", job_id)
+        job_ids += [follower.decode('utf-8') for follower in followers]
+
+    # Store the result and wake any API request blocked on BLPOP notify:{job_id},
+    # sent as a single pipeline write; SET is queued first so the waiter always finds it
+    async with redis.pipeline(transaction=False) as pipe:
+        for result_job_id in job_ids:
+            pipe.set(f"result:{result_job_id}", output, ex=300)
+            pipe.lpush(f"notify:{result_job_id}", "1")
+            pipe.expire(f"notify:{result_job_id}", 300)
+        pipe.delete(f"stream:{job_id}")
+        pipe.incr("jobs_done")
+        await pipe.execute()
+
+async def generate_streamed(kind: str, prompt: str, redis, job_id: str):
+    # Stream tokens into stream:{job_id} so the frontend can show partial output
+    stream_key = f"stream:{job_id}"
+    response = await models[kind].generate_content_async(prompt, stream=True)
+    first = True
+    async for chunk in response:
+        if not chunk.parts: continue
+        await redis.append(stream_key, chunk.text)
+        if first:
+            await redis.expire(stream_key, 300)
+            first = False
+    return response
+
+# --- Worker Functions (The Jobs) ---
+# Must match JOB_TIMEOUT/INFLIGHT_TTL in main.py
+JOB_TIMEOUT = 300
+INFLIGHT_TTL = JOB_TIMEOUT + 60
+MAX_TRIES = 5
+TIMEOUT_MESSAGE = "Error: Job timed out"
+CANCELLED_MESSAGE = "Error: Job was cancelled"
+
+async def run_and_publish(ctx, job_id: str, inflight_key: str, job_name: str, work):
+    # Publishes exactly once, when the job is really finished, so the single-flight lock is
+    # released and every waiting request gets an answer
+    redis = ctx['redis']
+    try:
+        if inflight_key: await redis.eval(REFRESH_LOCK_SCRIPT, 1, inflight_key, job_id, INFLIGHT_TTL)
+        # Enforced here (arq's job_timeout is set higher) so a timeout can be told apart
+        # from the CancelledError arq raises on worker shutdown
+        output = await asyncio.wait_for(work, JOB_TIMEOUT)
+    except asyncio.TimeoutError:
+        print(f"WORKER ERROR in '{job_name}': timed out after {JOB_TIMEOUT}s")
+        output = TIMEOUT_MESSAGE
+    except asyncio.CancelledError:
+        # Worker shutdown: arq reruns the job (retry_jobs), so leave the lock and waiters to the retry
+        if ctx['job_try'] < MAX_TRIES: raise
+        await publish_result(redis, job_id, CANCELLED_MESSAGE, inflight_key)
+        raise
     except Exception as e:
-        error_message = f"WORKER ERROR in 'run_transcript_analysis': {e}"
+        error_message = f"WORKER ERROR in '{job_name}': {e}"
         print(error_message)
-        await redis.set(f"result:{job_id}", f"Error: {e}", ex=300)
+        output = f"Error: {e}"
+    await publish_result(redis, job_id, output, inflight_key)
+
+async def analyze_transcript(ctx, job_id: str, item_dict: dict) -> str:
+    redis = ctx['redis'] 
+    if models["transcript"] is None or (supabase is None and ctx.get('pg_pool') is None):
+        print("WORKER ERROR: Models or Supabase not initialized.")
+        return "Error: Worker not initialized"
+
+    transcript = await fit_to_token_budget("transcript", item_dict.get('transcript'))
+    prompt = PROMPT_TEMPLATES["transcript"].format_map({**item_dict, "transcript": transcript})
+    
+    scope = semantic_scope(item_dict.get('company'), item_dict.get('date'), item_dict.get('attendees'))
+    vector, output = await semantic_cache_lookup(ctx, "transcript", item_dict.get('transcript'), scope)
+    if output is None:
+        response = await generate_streamed("transcript", prompt, redis, job_id)
+        output = response.text.rstrip()
+        await semantic_cache_store(redis, "transcript", item_dict.get('transcript'), vector, scope, output)
+
+    # 1. Save to Supabase (for history)
+    # *** THIS IS THE FIX ***
+    data_to_insert = {
+        "company": item_dict.get('company'),
+        "attendees": item_dict.get('attendees'),
+        "date": item_dict.get('date'),
+        "transcript": item_dict.get('transcript'),
+        "analysis": output,
+    }
+    await insert_queues["meeting_analysis"].put(data_to_insert)
+    
+    # 2. Result goes to Redis FOR THE FRONTEND in run_and_publish
+    print(f"WORKER: Successfully processed job {job_id}")
+    return output
 
 
-async def run_icebreaker_generation(ctx, job_id: str, item_dict: dict):
+async def generate_icebreaker(ctx, job_id: str, item_dict: dict) -> str:
     redis = ctx['redis']
-    if icebreaker_model is None or supabase is None:
+    if models["icebreaker"] is None or (supabase is None and ctx.get('pg_pool') is None):
         print("WORKER ERROR: Models or Supabase not initialized.")
-        await redis.set(f"result:{job_id}", "Error: Worker not initialized", ex=300)
-        return
+        return "Error: Worker not initialized"
 
-    try:
-        prompt = f"""
-        Analyze this LinkedIn bio and pitch deck.
-        Bio: {item_dict.get('linkedin_bio')}
-        Deck: {item_dict.get('pitch_deck')}
-        
-        Generate a cold outreach icebreaker... (rest of your prompt)
-        
-        IMPORTANT: Format your entire response using Markdown.
-        """
-        
-        response = icebreaker_model.generate_content(prompt)
-        output = response.text.strip()
-
-        # 1. Save to Supabase (for history)
-        # *** THIS IS THE FIX ***
-        data_to_insert = {
-            "linkedin_bio": item_dict.get('linkedin_bio'),
-            "pitch_deck": item_dict.get('pitch_deck'),
-            "analysis": output,
-        }
-        supabase.table("icebreaker_analysis").insert(data_to_insert).execute()
-        
-        # 2. Save result to Redis FOR THE FRONTEND
-        await redis.set(f"result:{job_id}", output, ex=300) 
-        
-        print(f"WORKER: Successfully processed job {job_id}")
+    pitch_deck = await fit_to_token_budget("icebreaker", item_dict.get('pitch_deck'))
+    prompt = PROMPT_TEMPLATES["icebreaker"].format_map({**item_dict, "pitch_deck": pitch_deck})
+    
+    scope = semantic_scope(item_dict.get('linkedin_bio'))
+    vector, output = await semantic_cache_lookup(ctx, "icebreaker", item_dict.get('pitch_deck'), scope)
+    if output is None:
+        response = await generate_streamed("icebreaker", prompt, redis, job_id)
+        output = response.text.rstrip()
+        await semantic_cache_store(redis, "icebreaker", item_dict.get('pitch_deck'), vector, scope, output)
+
+    # 1. Save to Supabase (for history)
+    # *** THIS IS THE FIX ***
+    data_to_insert = {
+        "linkedin_bio": item_dict.get('linkedin_bio'),
+        "pitch_deck": item_dict.get('pitch_deck'),
+        "analysis": output,
+    }
+    await insert_queues["icebreaker_analysis"].put(data_to_insert)
+    
+    # 2. Result goes to Redis FOR THE FRONTEND in run_and_publish
+    print(f"WORKER: Successfully processed job {job_id}")
+    return output
+
+
+async def run_transcript_analysis(ctx, job_id: str, item_dict: dict, inflight_key: str = None):
+    await run_and_publish(ctx, job_id, inflight_key, 'run_transcript_analysis', analyze_transcript(ctx, job_id, item_dict))
 
-    except Exception as e:
-        error_message = f"WORKER ERROR in 'run_icebreaker_generation': {e}"
-        print(error_message)
-        await redis.set(f"result:{job_id}", f"Error: {e}", ex=300)
+
+async def run_icebreaker_generation(ctx, job_id: str, item_dict: dict, inflight_key: str = None):
+    await run_and_publish(ctx, job_id, inflight_key, 'run_icebreaker_generation', generate_icebreaker(ctx, job_id, item_dict))
 
 # --- Worker Settings ---
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
 
+async def startup(ctx):
+    if gemini_api_key:
+        try:
+            for kind in models: models[kind] = build_model(kind)
+        except Exception as e: print(f"Error initializing GenerativeModels: {e}")
+    ctx['semantic_cache'] = bool(gemini_api_key) and await ensure_semantic_indexes(ctx['redis'])
+    # Inserts go through asyncpg when SUPABASE_PG_DSN is set, falling back to Supabase REST on errors
+    ctx['pg_pool'] = await create_pg_pool()
+    ctx['insert_writers'] = [asyncio.create_task(insert_writer(table, queue, ctx['pg_pool'])) for table, queue in insert_queues.items()]
+
+async def shutdown(ctx):
+    for task in ctx['insert_writers']: task.cancel()
+    await asyncio.gather(*ctx['insert_writers'], return_exceptions=True)
+    if ctx['pg_pool'] is not None: await ctx['pg_pool'].close()
+
 class WorkerSettings:
     functions = [run_transcript_analysis, run_icebreaker_generation]
     redis_settings = RedisSettings.from_dsn(REDIS_URL)
+    # msgpack instead of arq's default pickle; must match main.py
+    job_serializer = partial(msgpack.packb, use_bin_type=True)
+    job_deserializer = partial(msgpack.unpackb, raw=False)
+    on_startup = startup
+    on_shutdown = shutdown
+    # Backstop only: run_and_publish enforces JOB_TIMEOUT itself and needs time to publish
+    job_timeout = JOB_TIMEOUT + 30
+    max_tries = MAX_TRIES
+    # Released arq has no streams delivery yet; poll faster instead
+    poll_delay = 0.1
     
 if __name__ == "__main__":
     arq.run_worker(WorkerSettings)
\ No newline at end of file